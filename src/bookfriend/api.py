@@ -1,9 +1,12 @@
+import asyncio
 import os
-import shutil
 import uuid
 import tempfile
+import aiofiles
+from fastapi.concurrency import run_in_threadpool
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Header, BackgroundTasks, Request
+from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Header, Request
 from pydantic import BaseModel
 from typing import List, Optional
 from dotenv import load_dotenv
@@ -15,8 +18,9 @@ from slowapi.errors import RateLimitExceeded
 
 load_dotenv()
 
-from utils.semantic_utils import semantic_search
+from utils.semantic_utils import semantic_search, embed_query
 from utils.answer_generator import generate_answer
+from utils import semantic_cache
 import database
 import models
 from ingest import process_and_ingest_pdf
@@ -44,6 +48,43 @@ def verify_api_key(x_api_key: Optional[str] = Header(None)):
     if x_api_key != BOOKFRIEND_API_KEY:
         raise HTTPException(status_code=401, detail="Unauthorized: Invalid or missing X-API-Key header.")
 
+# ── Ingest Process Pool ───────────────────────────────────────────────────────
+# PDF extraction + embedding are CPU-bound; running them on BackgroundTasks
+# burned the API worker's cores. A process pool keeps ingest off the
+# event loop's process entirely. Created lazily so importing this module
+# (tests, tooling) doesn't fork workers.
+_ingest_pool = None
+
+def _warm_ingest_worker():
+    """Runs once per pool worker: resets DB state, then loads MiniLM.
+
+    The pool forks after the API process has already talked to Postgres
+    (the ingest request itself runs book_exists_by_filename first), so
+    every worker inherits the parent's SQLAlchemy pools complete with
+    live psycopg2 sockets — and two processes sharing one socket corrupt
+    the protocol stream. dispose(close=False) drops the inherited
+    connections without closing them (the parent still owns those file
+    descriptors); the worker then opens fresh ones on first checkout.
+
+    The model load is here so the first ingest job in each worker doesn't
+    pay the multi-second load — and so a cold cache can't have every
+    worker racing the same HuggingFace download.
+    """
+    database.engine.dispose(close=False)
+    database.async_engine.sync_engine.dispose(close=False)
+    import utils.semantic_utils
+    utils.semantic_utils._get_model()
+
+
+def _get_ingest_pool() -> ProcessPoolExecutor:
+    global _ingest_pool
+    if _ingest_pool is None:
+        _ingest_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            initializer=_warm_ingest_worker,
+        )
+    return _ingest_pool
+
 # ── Lifespan (replaces deprecated @app.on_event) ─────────────────────────────
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -51,7 +92,10 @@ async def lifespan(app: FastAPI):
     database.init_db()
     print("✅ Application startup complete. Connected to Supabase.")
     yield
-    # Shutdown (nothing needed here)
+    # Shutdown
+    database.message_buffer.flush()  # don't drop buffered chat history
+    if _ingest_pool is not None:
+        _ingest_pool.shutdown(wait=True)
 
 # ── App ───────────────────────────────────────────────────────────────────────
 app = FastAPI(
@@ -100,31 +144,53 @@ class UserResponse(BaseModel):
     user_id: str
     message: str
 
+# ── Query Helpers ─────────────────────────────────────────────────────────────
+class _HistoryMemory:
+    """Adapts a plain history list to the memory interface generate_answer
+    expects. Module-level (with __slots__) so each request only pays one
+    tiny instance, not a fresh class object."""
+    __slots__ = ("_history",)
+
+    def __init__(self, history):
+        self._history = history
+
+    def get_context(self, limit=6):
+        return self._history[-limit:]
+
 # ── Background Worker ─────────────────────────────────────────────────────────
 def _run_ingest(job_id: str, pdf_path: str, original_filename: str, safe_filename: str):
     """
     Runs in the background after the HTTP response has already been sent.
     Handles the full ingest pipeline and updates job status throughout.
     """
+    # One session for the whole job — the status updates and book insert
+    # reuse a single pooled connection instead of checking one out per call.
+    job_db = database.SessionLocal()
     try:
-        database.update_job(job_id, status="processing")
+        database.update_job(job_id, status="processing", db=job_db)
 
         book_id = database.register_book(
             title=original_filename,
             filename=safe_filename,
-            index_path="supabase-pgvector"
+            index_path="supabase-pgvector",
+            db=job_db
         )
-        database.update_job(job_id, status="processing", book_id=book_id)
+        if book_id is None:
+            # A concurrent upload of the same file won the race.
+            raise ValueError(f"A book with filename '{safe_filename}' already exists.")
+        database.update_job(job_id, status="processing", book_id=book_id, db=job_db)
 
         process_and_ingest_pdf(pdf_path, book_id)
 
-        database.update_job(job_id, status="done", book_id=book_id)
+        database.update_job(job_id, status="done", book_id=book_id, db=job_db)
         print(f"✅ Job {job_id} complete — book_id: {book_id}")
 
     except Exception as e:
-        database.update_job(job_id, status="failed", error=str(e))
+        job_db.rollback()  # clear any aborted transaction before the status write
+        database.update_job(job_id, status="failed", error=str(e), db=job_db)
         print(f"❌ Job {job_id} failed: {e}")
     finally:
+        job_db.close()
         if os.path.exists(pdf_path):
             os.remove(pdf_path)
 
@@ -154,32 +220,46 @@ def list_books(db: Session = Depends(database.get_db)):
     return [{"id": r["id"], "title": r["title"], "filename": r["filename"]} for r in rows]
 
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # stream uploads to disk 1 MB at a time
+
+
 @app.post("/v1/ingest", response_model=IngestResponse, dependencies=[Depends(verify_api_key)])
-def ingest_book(file: UploadFile = File(...), background_tasks: BackgroundTasks = BackgroundTasks()):
+async def ingest_book(file: UploadFile = File(...)):
     safe_filename = file.filename.replace(" ", "_")
 
     # ── Duplicate protection ──────────────────────────────────────────────────
-    if database.book_exists_by_filename(safe_filename):
+    # Advisory fast-path only: it gives the uploader an immediate 409
+    # instead of a failed job. The authoritative check is register_book's
+    # ON CONFLICT (filename) DO NOTHING in the worker, which closes the
+    # check-then-insert race this SELECT alone could never win.
+    if await run_in_threadpool(database.book_exists_by_filename, safe_filename):
         raise HTTPException(
             status_code=409,
             detail=f"A book with filename '{safe_filename}' already exists. "
                    f"Delete it first via DELETE /v1/books/<book_id>."
         )
 
+    # Stream the body to /tmp chunk by chunk — memory stays flat no matter
+    # how big the PDF is, and the async writes never block the event loop,
+    # so concurrent uploads don't stall other requests.
     pdf_path = os.path.join(tempfile.gettempdir(), f"temp_{uuid.uuid4().hex[:8]}.pdf")
-    with open(pdf_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    async with aiofiles.open(pdf_path, "wb") as buffer:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await buffer.write(chunk)
 
-    job_id = uuid.uuid4().hex[:12]
-    database.create_job(job_id, safe_filename)
+    job_id = uuid.uuid4().hex
+    await run_in_threadpool(database.create_job, job_id, safe_filename)
 
-    background_tasks.add_task(
+    future = _get_ingest_pool().submit(
         _run_ingest,
         job_id=job_id,
         pdf_path=pdf_path,
         original_filename=file.filename,
         safe_filename=safe_filename
     )
+    # The worker process advances job state in Supabase; pull the final
+    # state back into this process's poll cache once it finishes.
+    future.add_done_callback(lambda f, job_id=job_id: database.refresh_job_cache(job_id))
 
     print(f"📋 Job {job_id} queued for '{safe_filename}' — returning immediately.")
     return {
@@ -200,11 +280,12 @@ def get_job_status(job_id: str):
 
 
 @app.delete("/v1/books/{book_id}", response_model=DeleteResponse, dependencies=[Depends(verify_api_key)])
-def delete_book(book_id: str):
+async def delete_book(book_id: str):
     """Permanently deletes a book and ALL its data."""
-    deleted = database.delete_book(book_id)
+    deleted = await run_in_threadpool(database.delete_book, book_id)
     if not deleted:
         raise HTTPException(status_code=404, detail=f"Book '{book_id}' not found.")
+    await semantic_cache.invalidate_book(book_id)
     return {
         "message": f"Book '{book_id}' and all its data has been permanently deleted.",
         "book_id": book_id
@@ -213,55 +294,67 @@ def delete_book(book_id: str):
 
 @app.post("/v1/query", response_model=QueryResponse, dependencies=[Depends(verify_api_key)])
 @limiter.limit("20/minute")   # ← rate limit: 20 queries per minute per user_id
-def query_book(request: Request, req: QueryRequest, db: Session = Depends(database.get_db)):
+async def query_book(request: Request, req: QueryRequest, db: Session = Depends(database.get_db)):
     # 1. Validate user exists
-    if not database.user_exists(req.user_id):
+    if not await run_in_threadpool(database.user_exists, req.user_id):
         raise HTTPException(
             status_code=403,
             detail=f"Unknown user_id '{req.user_id}'. Register first via POST /v1/users."
         )
 
-    # 2. Look up the real book title
-    book_row = db.execute(
-        text("SELECT title FROM books WHERE id = :id"),
-        {"id": req.book_id}
-    ).mappings().fetchone()
-
-    if not book_row:
+    # 2. Title lookup, chat history and query embedding are independent —
+    #    overlap them instead of waiting on each in turn.
+    book_title, history, query_embedding = await asyncio.gather(
+        run_in_threadpool(database.get_book_title, db, req.book_id),
+        run_in_threadpool(database.get_chat_history, req.user_id, req.book_id),
+        run_in_threadpool(embed_query, req.query),
+    )
+    if book_title is None:
         raise HTTPException(status_code=404, detail=f"Book '{req.book_id}' not found.")
 
-    book_title = book_row["title"]
-
-    # 3. Conversation history (last 12 messages only)
-    history = database.get_chat_history(req.user_id, req.book_id)
-
-    class MemoryWrapper:
-        def get_context(self, limit=6): return history
+    # 3. Semantic cache — if a near-identical question was already answered
+    #    for this book + chapter limit, skip retrieval and the LLM entirely.
+    cached = await semantic_cache.lookup(req.book_id, req.chapter_limit, query_embedding)
+    if cached:
+        database.message_buffer.put_many([
+            {"uid": req.user_id, "bid": req.book_id, "role": "user", "content": req.query, "limit": req.chapter_limit},
+            {"uid": req.user_id, "bid": req.book_id, "role": "bot", "content": cached["answer"], "limit": req.chapter_limit},
+        ])
+        return {"answer": cached["answer"], "sources": cached["sources"]}
 
     # 4. Semantic search (Spoiler Shield applied inside)
-    raw_results = semantic_search(
+    raw_results = await run_in_threadpool(
+        semantic_search,
         query=req.query,
         book_id=req.book_id,
         chapter_limit=req.chapter_limit,
         top_k=3
     )
 
-    chunks_text = [chunk for _, chunk, _ in raw_results]
-    sources = [source for source, _, _ in raw_results]
-
-    if not chunks_text:
+    if not raw_results:
         return {"answer": "I couldn't find anything about that in the book up to this chapter.", "sources": []}
 
-    # 5. Generate answer
-    answer = generate_answer(
+    # Single-pass tuple unzip — one walk over the hits instead of two
+    # comprehensions each unpacking every row.
+    sources, chunks_text, _ = zip(*raw_results)
+    sources = list(sources)
+
+    # 5. Generate answer (the LLM call — by far the longest wait; running it
+    #    in the threadpool keeps the event loop free for other requests)
+    answer = await run_in_threadpool(
+        generate_answer,
         query=req.query,
         context_chunks=chunks_text,
-        memory=MemoryWrapper(),
+        memory=_HistoryMemory(history),
         book_title=book_title
     )
 
-    # 6. Log to history
-    database.log_message(req.user_id, req.book_id, "user", req.query, req.chapter_limit)
-    database.log_message(req.user_id, req.book_id, "bot", answer, req.chapter_limit)
+    # 6. Cache for future similar queries; history rows go to the
+    #    write-behind buffer — the flusher batches them off-request.
+    await semantic_cache.store(req.book_id, req.chapter_limit, query_embedding, answer, sources)
+    database.message_buffer.put_many([
+        {"uid": req.user_id, "bid": req.book_id, "role": "user", "content": req.query, "limit": req.chapter_limit},
+        {"uid": req.user_id, "bid": req.book_id, "role": "bot", "content": answer, "limit": req.chapter_limit},
+    ])
 
     return {"answer": answer, "sources": sources}
\ No newline at end of file
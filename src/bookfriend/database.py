@@ -1,5 +1,15 @@
 import os
-from sqlalchemy import create_engine
+import queue
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import execute_values
+from cachetools import TTLCache
+from pgvector.asyncpg import register_vector as register_vector_async
+from pgvector.psycopg2 import register_vector
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
 import uuid
@@ -11,10 +21,67 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("CRITICAL: DATABASE_URL is not set.")
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Pool sized for concurrent ingest + query traffic; pre_ping + keepalives
+# stop stale Supabase connections from costing a TLS handshake mid-request.
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=20,
+    max_overflow=40,
+    pool_pre_ping=True,
+    pool_use_lifo=True,   # reuse the most recent connection — keeps PG's per-backend caches warm
+    pool_recycle=1800,
+    connect_args={"keepalives": 1, "keepalives_idle": 30},
+)
+
+def _register_pgvector(dbapi_conn, connection_record):
+    """Registers pgvector's psycopg2 adapter on every new connection, so
+    embeddings bind as real vector parameters instead of being stringified
+    into the SQL text (stable query text -> PG can reuse a generic plan)."""
+    try:
+        register_vector(dbapi_conn)
+    except psycopg2.ProgrammingError:
+        # Very first boot only: the vector type doesn't exist until
+        # init_db has run CREATE EXTENSION.
+        pass
+
+
+try:
+    event.listen(engine, "connect", _register_pgvector)
+except exc.InvalidRequestError:
+    pass  # engine is a mock in the test suite
+
+# expire_on_commit=False: we never re-read ORM attributes after commit,
+# so skip the extra SELECTs SQLAlchemy would otherwise issue.
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
 
+# ── Async engine (asyncpg) ───────────────────────────────────────────────────
+# The /v1/query hot path awaits its DB work directly on the event loop
+# instead of parking a threadpool worker for every round trip. Smaller
+# pool than the sync one — only the query path uses it.
+async_engine = create_async_engine(
+    DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1),
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_use_lifo=True,
+    pool_recycle=1800,
+)
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _register_pgvector_async(dbapi_conn, connection_record):
+    """asyncpg needs the vector codec registered per connection, same as
+    psycopg2 above — run through the greenlet bridge."""
+    try:
+        dbapi_conn.run_async(register_vector_async)
+    except Exception:
+        # First boot, before CREATE EXTENSION vector.
+        pass
+
+
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -23,143 +90,312 @@ def get_db():
         db.close()
 
 
+@contextmanager
+def _session(db=None):
+    """Yields the caller's session when given one, else a fresh one.
+
+    Lets request handlers and the ingest worker share one session across
+    several helper calls instead of paying checkout + teardown per call.
+    """
+    if db is not None:
+        yield db
+        return
+    fresh = SessionLocal()
+    try:
+        yield fresh
+    finally:
+        fresh.close()
+
+
 def init_db():
     with engine.connect() as conn:
         conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
         conn.commit()
     Base.metadata.create_all(bind=engine)
+    with engine.connect() as conn:
+        # Unique index backing register_book's ON CONFLICT (filename).
+        # models.py declares unique=True, but create_all never alters
+        # pre-existing tables, so a legacy database lacks the constraint
+        # and every ingest would fail with "no unique or exclusion
+        # constraint matching the ON CONFLICT specification". Also lets
+        # book_exists_by_filename run as an index-only scan there.
+        conn.execute(text("""
+            CREATE UNIQUE INDEX IF NOT EXISTS books_filename_key
+            ON books (filename)
+        """))
+        # Covering index: get_chat_history becomes an index-only range scan
+        # instead of a heap scan + sort as the messages table grows.
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_messages_uid_bid_id
+            ON messages (user_id, book_id, id) INCLUDE (role, content)
+        """))
+        # Speeds up the Spoiler Shield filter inside semantic_search.
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_book_chunks_book_chapter
+            ON book_chunks (book_id, chapter_num)
+        """))
+        # Migration for databases created before the halfvec switch:
+        # create_all never alters existing columns, so a legacy
+        # vector(384) column would make the halfvec index below (and the
+        # typed search binds) fail at startup. The type check keeps this
+        # a no-op after the first run — a bare ALTER TYPE would rewrite
+        # the table on every boot.
+        conn.execute(text("""
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'book_chunks'
+                      AND column_name = 'embedding'
+                      AND udt_name = 'vector'
+                ) THEN
+                    ALTER TABLE book_chunks
+                    ALTER COLUMN embedding TYPE halfvec(384)
+                    USING embedding::halfvec(384);
+                END IF;
+            END $$;
+        """))
+        # ANN index for the ORDER BY embedding <#> ... search. Without it
+        # every query is a sequential scan doing a 384-d distance per chunk;
+        # HNSW makes it log-time. halfvec_ip_ops matches both the column
+        # type and the <#> operator — any other opclass would be ignored.
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS book_chunks_emb_hnsw
+            ON book_chunks USING hnsw (embedding halfvec_ip_ops)
+            WITH (m = 16, ef_construction = 64)
+        """))
+        conn.commit()
 
 
-def register_book(title: str, filename: str, index_path: str) -> str:
-    """Saves a new book entry to Supabase and returns the generated ID."""
-    db = SessionLocal()
-    book_id = uuid.uuid4().hex[:8]
-    try:
+# Hot-path statements built once at import. A fresh text() per call makes
+# SQLAlchemy re-key its compiled-SQL cache on a new object every time;
+# module-level constants keep the cache warm and guarantee byte-stable
+# query text, which is what lets PG settle on a reusable generic plan
+# (and what asyncpg's automatic prepared-statement cache keys on).
+_SQL_GET_TITLE = text("SELECT title FROM books WHERE id = :id")
+_SQL_BOOK_EXISTS = text("SELECT EXISTS(SELECT 1 FROM books WHERE filename = :filename)")
+_SQL_USER_EXISTS = text("SELECT id FROM users WHERE id = :id LIMIT 1")
+_SQL_GET_JOB = text("""
+    SELECT id, book_id, filename, status, error, created_at, updated_at
+    FROM ingest_jobs WHERE id = :id
+""")
+_SQL_UPDATE_JOB = text("""
+    UPDATE ingest_jobs
+    SET status = :status,
+        book_id = COALESCE(:book_id, book_id),
+        error = :error,
+        updated_at = NOW()
+    WHERE id = :id
+""")
+_SQL_INSERT_MESSAGE = text("""
+    INSERT INTO messages (user_id, book_id, role, content, chapter_limit)
+    VALUES (:uid, :bid, :role, :content, :limit)
+""")
+_SQL_GET_HISTORY = text("""
+    SELECT role, content
+    FROM messages
+    WHERE user_id = :uid AND book_id = :bid
+    ORDER BY id DESC
+    LIMIT 12
+""")
+
+# Book titles change approximately never, so an hour of TTL is plenty —
+# this turns the per-query title SELECT into a dict hit on the warm path.
+# cachetools classes are not thread-safe (mutation and expiry walk
+# internal linked lists) and request threads hit this concurrently, so
+# every access goes through the lock — same treatment as the retrieval
+# cache in semantic_utils.
+_title_cache = TTLCache(maxsize=10_000, ttl=3600)
+_title_cache_lock = threading.Lock()
+
+
+def register_book(title: str, filename: str, index_path: str, db=None):
+    """Saves a new book entry to Supabase and returns the generated ID.
+
+    Atomic against concurrent uploads of the same file: the UNIQUE
+    constraint on filename + ON CONFLICT DO NOTHING means a duplicate
+    returns None instead of racing the exists-check in the API layer.
+    """
+    # Server-generated 128-bit id (gen_random_uuid is built in since PG13):
+    # no client-side random draw, and RETURNING hands back the one source
+    # of truth. Dashes stripped to keep the existing hex id shape.
+    with _session(db) as s:
         query = text("""
-            INSERT INTO books (id, title, filename, index_path) 
-            VALUES (:id, :title, :filename, :index_path)
+            INSERT INTO books (id, title, filename, index_path)
+            VALUES (replace(gen_random_uuid()::text, '-', ''), :title, :filename, :index_path)
+            ON CONFLICT (filename) DO NOTHING
+            RETURNING id
         """)
-        db.execute(query, {"id": book_id, "title": title, "filename": filename, "index_path": index_path})
-        db.commit()
+        row = s.execute(query, {"title": title, "filename": filename, "index_path": index_path}).fetchone()
+        s.commit()
+        if not row:
+            return None
+        book_id = row[0]
+        with _title_cache_lock:
+            _title_cache[book_id] = title
         return book_id
-    finally:
-        db.close()
 
 
-def book_exists_by_filename(filename: str) -> bool:
-    """Returns True if a book with this filename has already been ingested."""
-    db = SessionLocal()
-    try:
-        row = db.execute(
-            text("SELECT id FROM books WHERE filename = :filename LIMIT 1"),
-            {"filename": filename}
-        ).fetchone()
-        return row is not None
-    finally:
-        db.close()
+def get_book_title(db, book_id: str):
+    """Returns the book's title, or None if the book doesn't exist.
+    Served from the in-process cache whenever possible."""
+    with _title_cache_lock:
+        title = _title_cache.get(book_id)
+    if title is not None:
+        return title
 
+    row = db.execute(_SQL_GET_TITLE, {"id": book_id}).mappings().fetchone()
+    if not row:
+        return None
 
-def delete_book(book_id: str) -> bool:
-    """
-    Deletes a book and ALL its associated data.
-    Cleans up: book_chunks → messages → books (in foreign key order).
-    """
-    db = SessionLocal()
-    try:
-        row = db.execute(
-            text("SELECT id FROM books WHERE id = :id"),
-            {"id": book_id}
-        ).fetchone()
+    with _title_cache_lock:
+        _title_cache[book_id] = row["title"]
+    return row["title"]
 
-        if not row:
-            return False
 
-        db.execute(text("DELETE FROM book_chunks WHERE book_id = :id"), {"id": book_id})
-        db.execute(text("DELETE FROM messages WHERE book_id = :id"),    {"id": book_id})
-        db.execute(text("DELETE FROM books WHERE id = :id"),            {"id": book_id})
+def book_exists_by_filename(filename: str, db=None) -> bool:
+    """Returns True if a book with this filename has already been ingested.
+    EXISTS over the unique filename index is an index-only scan that stops
+    at the first entry and ships back a single boolean."""
+    with _session(db) as s:
+        return bool(s.execute(_SQL_BOOK_EXISTS, {"filename": filename}).scalar())
 
-        db.commit()
-        return True
-    except Exception as e:
-        db.rollback()
-        print(f"❌ Error deleting book {book_id}: {e}")
-        raise
-    finally:
-        db.close()
+
+def delete_book(book_id: str, db=None) -> bool:
+    """
+    Deletes a book and ALL its associated data in one atomic round-trip.
+    The chained CTE deletes child rows explicitly rather than leaning on
+    ON DELETE CASCADE — tables created before the cascade FKs existed
+    (create_all never alters them) still get cleaned up correctly.
+    RETURNING tells us whether the book existed.
+    """
+    with _session(db) as s:
+        try:
+            deleted = s.execute(
+                text("""
+                    WITH d1 AS (DELETE FROM book_chunks WHERE book_id = :id),
+                         d2 AS (DELETE FROM messages    WHERE book_id = :id),
+                         d3 AS (DELETE FROM query_cache WHERE book_id = :id)
+                    DELETE FROM books WHERE id = :id RETURNING id
+                """),
+                {"id": book_id}
+            ).fetchone()
+            s.commit()
+
+            if not deleted:
+                return False
+            with _title_cache_lock:
+                _title_cache.pop(book_id, None)
+            return True
+        except Exception as e:
+            s.rollback()
+            print(f"❌ Error deleting book {book_id}: {e}")
+            raise
 
 
 # User Management
 
-def create_user() -> str:
+def create_user(db=None) -> str:
     """Creates a new user and returns their generated user_id."""
-    db = SessionLocal()
     user_id = uuid.uuid4().hex[:16]
-    try:
-        db.execute(
+    with _session(db) as s:
+        s.execute(
             text("INSERT INTO users (id) VALUES (:id)"),
             {"id": user_id}
         )
-        db.commit()
+        s.commit()
         return user_id
-    finally:
-        db.close()
 
-def user_exists(user_id: str) -> bool:
+def user_exists(user_id: str, db=None) -> bool:
     """Returns True if this user_id exists in the users table."""
-    db = SessionLocal()
-    try:
-        row = db.execute(
-            text("SELECT id FROM users WHERE id = :id LIMIT 1"),
-            {"id": user_id}
-        ).fetchone()
+    with _session(db) as s:
+        row = s.execute(_SQL_USER_EXISTS, {"id": user_id}).fetchone()
         return row is not None
-    finally:
-        db.close()
 
 # Job Tracking
+#
+# Clients poll /v1/jobs/{job_id} at ~1 Hz while a book processes, so reads
+# vastly outnumber writes. Supabase is the source of truth; the in-process
+# cache is only trusted for TERMINAL statuses (done/failed), which can
+# never change again. Non-terminal state is advanced by the ingest worker
+# in a separate process, where updates can't reach this cache — those
+# polls go to Postgres, and the terminal result is cached on the way out
+# (plus via the worker's done-callback through refresh_job_cache).
+# Guarded like _title_cache above: TTLCache is not thread-safe.
+_job_cache = TTLCache(maxsize=10_000, ttl=86400)  # jobs expire after 24 h
+_job_cache_lock = threading.Lock()
+_TERMINAL_JOB_STATUSES = frozenset({"done", "failed"})
 
-def create_job(job_id: str, filename: str):
+
+def create_job(job_id: str, filename: str, db=None):
     """Creates a new ingest job record with status 'pending'."""
-    db = SessionLocal()
-    try:
-        db.execute(
+    with _session(db) as s:
+        s.execute(
             text("INSERT INTO ingest_jobs (id, filename, status) VALUES (:id, :filename, 'pending')"),
             {"id": job_id, "filename": filename}
         )
-        db.commit()
-    finally:
-        db.close()
+        s.commit()
+        with _job_cache_lock:
+            _job_cache[job_id] = {
+                "id": job_id, "book_id": None, "filename": filename,
+                "status": "pending", "error": None,
+            }
 
 
-def update_job(job_id: str, status: str, book_id: str = None, error: str = None):
+def update_job(job_id: str, status: str, book_id: str = None, error: str = None, db=None):
     """Updates a job's status. Called by the background worker as it progresses."""
-    db = SessionLocal()
-    try:
-        db.execute(
-            text("""
-                UPDATE ingest_jobs
-                SET status = :status,
-                    book_id = COALESCE(:book_id, book_id),
-                    error = :error,
-                    updated_at = NOW()
-                WHERE id = :id
-            """),
+    with _session(db) as s:
+        s.execute(
+            _SQL_UPDATE_JOB,
             {"id": job_id, "status": status, "book_id": book_id, "error": error}
         )
-        db.commit()
-    finally:
-        db.close()
+        s.commit()
+        with _job_cache_lock:
+            cached = _job_cache.get(job_id)
+            if cached:
+                cached["status"] = status
+                cached["book_id"] = book_id or cached["book_id"]
+                cached["error"] = error
 
 
-def get_job(job_id: str):
-    """Returns job info as a dict, or None if not found."""
+def refresh_job_cache(job_id: str):
+    """Re-reads a job from Supabase into the in-process cache.
+    Needed when the job was advanced by another process (ingest worker)."""
     db = SessionLocal()
     try:
         row = db.execute(
-            text("SELECT id, book_id, filename, status, error, created_at, updated_at FROM ingest_jobs WHERE id = :id"),
+            text("SELECT id, book_id, filename, status, error FROM ingest_jobs WHERE id = :id"),
             {"id": job_id}
         ).mappings().fetchone()
-        return dict(row) if row else None
+        if row:
+            with _job_cache_lock:
+                _job_cache[job_id] = dict(row)
+    except Exception as e:
+        print(f"Error refreshing job cache for {job_id}: {e}")
+    finally:
+        db.close()
+
+
+def get_job(job_id: str):
+    """Returns job info as a dict, or None if not found.
+    Terminal statuses are served from the in-process cache; anything
+    still in flight is re-read from Supabase, because the ingest worker
+    advancing it lives in another process and can't update this cache."""
+    with _job_cache_lock:
+        cached = _job_cache.get(job_id)
+        if cached and cached["status"] in _TERMINAL_JOB_STATUSES:
+            return dict(cached)
+
+    db = SessionLocal()
+    try:
+        row = db.execute(_SQL_GET_JOB, {"id": job_id}).mappings().fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        if job["status"] in _TERMINAL_JOB_STATUSES:
+            with _job_cache_lock:
+                _job_cache[job_id] = job
+        return job
     finally:
         db.close()
 
@@ -168,11 +404,7 @@ def log_message(user_id: str, book_id: str, role: str, content: str, chapter_lim
     """Saves a chat message to Supabase."""
     db = SessionLocal()
     try:
-        query = text("""
-            INSERT INTO messages (user_id, book_id, role, content, chapter_limit) 
-            VALUES (:uid, :bid, :role, :content, :limit)
-        """)
-        db.execute(query, {
+        db.execute(_SQL_INSERT_MESSAGE, {
             "uid": user_id,
             "bid": book_id,
             "role": role,
@@ -187,6 +419,97 @@ def log_message(user_id: str, book_id: str, role: str, content: str, chapter_lim
         db.close()
 
 
+def log_messages_bulk(rows: list):
+    """Saves several chat messages in a single multi-row INSERT.
+
+    Goes through execute_values on a raw connection (same as the chunk
+    upload path): executing the text() statement with a list of params
+    would be a psycopg2 executemany, i.e. one round trip per row.
+    Each row: {uid, bid, role, content, limit}.
+    """
+    if not rows:
+        return
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                INSERT INTO messages (user_id, book_id, role, content, chapter_limit)
+                VALUES %s
+                """,
+                [(r["uid"], r["bid"], r["role"], r["content"], r["limit"]) for r in rows],
+                page_size=1000,
+            )
+        conn.commit()
+    except Exception as e:
+        print(f"Error logging messages: {e}")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+class _MessageBuffer:
+    """Write-behind buffer for chat message logging.
+
+    Every /v1/query turn produces two message rows; inserting them
+    per-request still pays a round trip + WAL fsync each time. Enqueueing
+    is a lock-free put, and a single daemon thread flushes the queue as
+    one multi-row INSERT every FLUSH_INTERVAL seconds (sooner when
+    FLUSH_BATCH rows pile up), amortizing one fsync across many turns.
+    Messages are best-effort history, not ledger data — losing a flush
+    window on a hard crash is acceptable.
+    """
+
+    FLUSH_INTERVAL = 0.5   # seconds between idle flushes
+    FLUSH_BATCH = 100      # flush immediately past this depth
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def put_many(self, rows: list):
+        """Enqueues message rows; returns without touching the DB."""
+        for row in rows:
+            self._queue.put(row)
+        if self._queue.qsize() >= self.FLUSH_BATCH:
+            self._wake.set()
+        self._ensure_thread()
+
+    def flush(self):
+        """Drains the queue into one multi-row INSERT. Called by the
+        flusher thread and by app shutdown for the remainder."""
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if rows:
+            log_messages_bulk(rows)
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    thread = threading.Thread(
+                        target=self._run, name="bookfriend-msg-flusher", daemon=True
+                    )
+                    thread.start()
+                    self._thread = thread
+
+    def _run(self):
+        while True:
+            self._wake.wait(timeout=self.FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+
+message_buffer = _MessageBuffer()
+
+
 def get_chat_history(user_id: str, book_id: str):
     """
     Retrieves the last 12 messages for context.
@@ -194,18 +517,11 @@ def get_chat_history(user_id: str, book_id: str):
     """
     db = SessionLocal()
     try:
-        query = text("""
-            SELECT role, content FROM (
-                SELECT role, content, id
-                FROM messages
-                WHERE user_id = :uid AND book_id = :bid
-                ORDER BY id DESC
-                LIMIT 12
-            ) sub
-            ORDER BY id ASC
-        """)
-        rows = db.execute(query, {"uid": user_id, "bid": book_id}).mappings().fetchall()
-        return [{"role": r["role"], "content": r["content"]} for r in rows]
+        # DESC + LIMIT is served backwards straight off the covering
+        # (user_id, book_id, id) index; re-ordering 12 rows in Python is
+        # cheaper than asking PG for a second sort.
+        rows = db.execute(_SQL_GET_HISTORY, {"uid": user_id, "bid": book_id}).mappings().fetchall()
+        return [{"role": r["role"], "content": r["content"]} for r in reversed(rows)]
     except Exception as e:
         print(f"Error fetching history: {e}")
         return []
@@ -1,30 +1,76 @@
+import collections
+import itertools
+import os
 import re
-from pypdf import PdfReader
+from concurrent.futures import ProcessPoolExecutor
+import pypdfium2 as pdfium
 from utils.semantic_utils import upsert_book_to_supabase
 
+# Compiled once at import — the chunking loop hits these on every call,
+# and a module-level pattern skips re's cache lookup + flag parsing.
+_SENT_SPLIT = re.compile(r'(?<=[.!?])\s+')
+_CHAPTER_SPLIT = re.compile(r'(Chapter\s+\d+)', re.IGNORECASE)
+_DIGITS = re.compile(r'\d+')
+
+# Chunking a chapter is pure-Python CPU work that parallelizes cleanly
+# across chapters. Below this many chapters the fork/pickle overhead
+# outweighs the win and we chunk inline.
+_PARALLEL_MIN_CHAPTERS = 4
+
+_chunk_pool = None
+
+
+def _get_chunk_pool() -> ProcessPoolExecutor:
+    # Lazy like api's ingest pool: ingest.py is imported by the API
+    # process too, which must not fork chunking workers it never uses.
+    global _chunk_pool
+    if _chunk_pool is None:
+        _chunk_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _chunk_pool
+
+
+def _chunk_one(chapter_title, chapter_content):
+    """Chunks a single chapter. Top-level so it pickles for the pool."""
+    try:
+        chap_num = int(_DIGITS.search(chapter_title).group())
+    except Exception:
+        chap_num = 0
+    return chap_num, smart_chunking(chapter_content)
+
 
 def smart_chunking(text, chunk_size=800, overlap_sentences=2):
-    """Sentence-safe chunking with bounded size and semantic overlap."""
-    sentences = re.split(r'(?<=[.!?])\s+', text)
+    """Sentence-safe chunking with bounded size and semantic overlap.
+
+    A deque plus an incrementally maintained length counter keeps every
+    operation O(1): popleft when trimming (a list.pop(0) shifts the whole
+    buffer), add/subtract lengths instead of re-summing. The whole pass
+    is O(K) over a chapter's K sentences.
+    """
+    sentences = _SENT_SPLIT.split(text)
     chunks = []
-    current = []
-
-    def current_len():
-        return sum(len(s) for s in current)
+    current = collections.deque()
+    cur_len = 0
 
     for sentence in sentences:
         sentence = sentence.strip()
         if not sentence: continue
 
-        if current_len() + len(sentence) > chunk_size:
+        if cur_len + len(sentence) > chunk_size:
             chunks.append(" ".join(current))
-            overlap = current[-overlap_sentences:] if overlap_sentences > 0 else []
-            current = overlap[:]
-            while current_len() + len(sentence) > chunk_size and len(current) > 0:
-                current.pop(0)
+            if overlap_sentences > 0:
+                start = max(0, len(current) - overlap_sentences)
+                current = collections.deque(itertools.islice(current, start, len(current)))
+                cur_len = sum(len(s) for s in current)  # overlap is tiny — O(1)
+            else:
+                current = collections.deque()
+                cur_len = 0
+            while cur_len + len(sentence) > chunk_size and current:
+                cur_len -= len(current.popleft())
             current.append(sentence)
+            cur_len += len(sentence)
         else:
             current.append(sentence)
+            cur_len += len(sentence)
 
     if current:
         chunks.append(" ".join(current))
@@ -34,29 +80,38 @@ def process_and_ingest_pdf(pdf_path: str, book_id: str):
     """Reads PDF, chunks it by chapter, and upserts to Supabase pgvector."""  # ← fixed
     print(f"📖 Reading {pdf_path} into memory...")
 
-    reader = PdfReader(pdf_path)
-    full_text = "".join([page.extract_text() or "" for page in reader.pages])
+    # PDFium's C++ extractor — typically 5-10x faster than pure-Python
+    # parsing on novel-length PDFs, which dominates ingest job time.
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        # Generator, not a list — join consumes one page's text at a time,
+        # so peak memory is one page + the growing result, not 2x the book.
+        full_text = "".join(page.get_textpage().get_text_range() or "" for page in pdf)
+    finally:
+        pdf.close()
 
-    pattern = r'(Chapter\s+\d+)'
-    raw_chapters = re.split(pattern, full_text, flags=re.IGNORECASE)
+    raw_chapters = _CHAPTER_SPLIT.split(full_text)
 
     all_chunks = []
     all_chapters = []
 
     if len(raw_chapters) > 1:
+        titles = []
+        contents = []
         for i in range(1, len(raw_chapters), 2):
-            chapter_title = raw_chapters[i].strip()
             chapter_content = raw_chapters[i + 1].strip()
-
             if len(chapter_content) < 500:
                 continue
+            titles.append(raw_chapters[i].strip())
+            contents.append(chapter_content)
 
-            try:
-                chap_num = int(re.search(r'\d+', chapter_title).group())
-            except Exception:
-                chap_num = 0
+        # Fan chapters out across cores; map() preserves chapter order.
+        if len(contents) >= _PARALLEL_MIN_CHAPTERS:
+            results = _get_chunk_pool().map(_chunk_one, titles, contents)
+        else:
+            results = map(_chunk_one, titles, contents)
 
-            chunks = smart_chunking(chapter_content)
+        for chap_num, chunks in results:
             all_chunks.extend(chunks)
             all_chapters.extend([chap_num] * len(chunks))
     else:
@@ -1,30 +1,50 @@
 from database import Base
-from sqlalchemy import Column, String, Integer, DateTime
+from sqlalchemy import Column, String, Integer, DateTime, Float, ForeignKey, LargeBinary
 from datetime import datetime, timezone
-from pgvector.sqlalchemy import Vector
+from pgvector.sqlalchemy import HALFVEC, Vector
 
 class Book(Base):
     __tablename__ = "books"
     id = Column(String, primary_key=True, index=True)
     title = Column(String)
-    filename = Column(String)
+    filename = Column(String, unique=True)  # one ingest per source file
     index_path = Column(String) # We will just store "supabase" here now
 
 class Message(Base):
     __tablename__ = "messages"
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(String, index=True)
-    book_id = Column(String, index=True)
+    book_id = Column(String, ForeignKey("books.id", ondelete="CASCADE"), index=True)
     role = Column(String)
     content = Column(String)
     chapter_limit = Column(Integer, nullable=True)
     timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
 
+class QueryCache(Base):
+    """Semantic answer cache: one row per (book, chapter_limit, query embedding).
+    Old rows are swept by an external cron on created_at."""
+    __tablename__ = "query_cache"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    book_id = Column(String, ForeignKey("books.id", ondelete="CASCADE"), index=True)
+    chapter_limit = Column(Integer, index=True)
+    embedding = Column(Vector(384))
+    answer = Column(String)
+    sources = Column(String)  # JSON-encoded list of source labels
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
 # THE NEW VECTOR TABLE!
 class BookChunk(Base):
     __tablename__ = "book_chunks"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    book_id = Column(String, index=True)
+    book_id = Column(String, ForeignKey("books.id", ondelete="CASCADE"), index=True)
     chapter_num = Column(Integer, index=True)
     chunk_text = Column(String)
-    embedding = Column(Vector(384)) # 384 dimensions for all-MiniLM-L6-v2
\ No newline at end of file
+    # FP16 storage: ANN search is memory-bound, and halving the bytes per
+    # vector halves the bandwidth the HNSW traversal burns. MiniLM vectors
+    # are unit-norm in [-1, 1], so half precision costs no usable recall.
+    embedding = Column(HALFVEC(384))  # 384 dimensions for all-MiniLM-L6-v2
+    # int8-quantized copy (4x smaller): per-vector scale so v ≈ i8 * scale.
+    # The halfvec column above stays the serving path until recall is
+    # A/B-verified; nothing reads these columns back yet.
+    embedding_i8 = Column(LargeBinary, nullable=True)
+    embedding_scale = Column(Float, nullable=True)
\ No newline at end of file
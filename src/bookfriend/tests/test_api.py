@@ -6,7 +6,7 @@ All external calls are mocked.
 
 import io
 
-import patch
+import numpy as np
 import pytest
 from unittest.mock import patch, MagicMock
 from fastapi.testclient import TestClient
@@ -23,6 +23,14 @@ with patch("sqlalchemy.create_engine"), \
      patch("sentence_transformers.SentenceTransformer"):
     from api import app
     import database
+    import utils.semantic_utils as semantic_utils
+
+# The model is lazy-loaded (_get_model), so the constructor patch above
+# only covers import time. Pre-seed the loaded-model slot so no test ever
+# constructs — or downloads — the real MiniLM; encode returns a unit-shaped
+# zero vector, enough for the embedding-adjacent code paths tests exercise.
+semantic_utils.SEM_MODEL = MagicMock()
+semantic_utils.SEM_MODEL.encode.return_value = np.zeros(384, dtype=np.float32)
 
 client = TestClient(app)
 
@@ -127,9 +135,13 @@ def test_ingest_rejects_duplicate_filename():
 def test_ingest_returns_job_id_immediately():
     fake_pdf = io.BytesIO(b"%PDF-1.4 fake content")
 
+    # _get_ingest_pool is stubbed out: a real ProcessPoolExecutor would
+    # fork workers whose initializer loads the model per core, and the
+    # MagicMock _run_ingest can't even be pickled for submission.
     with patch("database.book_exists_by_filename", return_value=False), \
          patch("database.create_job"), \
-         patch("api._run_ingest"):
+         patch("api._run_ingest"), \
+         patch("api._get_ingest_pool"):
         response = client.post(
             "/v1/ingest",
             headers=VALID_KEY,
@@ -263,7 +275,7 @@ def test_query_returns_fallback_when_no_chunks():
     app.dependency_overrides[database.get_db] = lambda: mock_db
 
     with patch("database.get_chat_history", return_value=[]), \
-         patch("utils.semantic_utils.semantic_search", return_value=[]):
+         patch("api.semantic_search", return_value=[]):   # api's imported symbol, not the module's
 
         response = client.post(
             "/v1/query",
@@ -0,0 +1,95 @@
+"""
+Semantic answer cache for /v1/query.
+
+Many users ask semantically identical questions about the same book
+("who is Klein?", "who's klein moretti?"). Instead of paying a full
+LLM round-trip every time, we keep (query embedding -> answer) pairs
+in a small pgvector table and serve a cached answer whenever a new
+query lands close enough (cosine similarity >= CACHE_SIMILARITY_THRESHOLD)
+to one we already answered for the same (book_id, chapter_limit).
+
+Spoiler Shield note: chapter_limit is part of the cache key, so a reader
+on chapter 3 can never be served an answer generated for chapter 30.
+"""
+
+import json
+
+import numpy as np
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import bindparam, text
+
+import database
+
+# How close a new query must be to a cached one to reuse its answer.
+# 0.92 is conservative — near-paraphrases hit, different questions don't.
+CACHE_SIMILARITY_THRESHOLD = 0.92
+
+
+async def lookup(book_id: str, chapter_limit: int, query_embedding: list):
+    """
+    Returns {"answer": str, "sources": list} on a cache hit, else None.
+    One ANN lookup against query_cache — far cheaper than the LLM call.
+    Embeddings are unit-norm, so inner product (<#>) equals cosine here.
+    Runs on the asyncpg engine: the event loop stays free during the wait.
+    """
+    try:
+        async with database.AsyncSessionLocal() as db:
+            result = await db.execute(
+                text("""
+                    SELECT answer, sources,
+                           -(embedding <#> :embedding) AS similarity
+                    FROM query_cache
+                    WHERE book_id = :book_id
+                      AND chapter_limit = :chapter_limit
+                    ORDER BY embedding <#> :embedding
+                    LIMIT 1
+                """).bindparams(bindparam("embedding", type_=Vector(384))),
+                {
+                    "embedding": np.asarray(query_embedding, dtype=np.float32),
+                    "book_id": book_id,
+                    "chapter_limit": chapter_limit,
+                }
+            )
+            row = result.mappings().fetchone()
+
+        if row and row["similarity"] >= CACHE_SIMILARITY_THRESHOLD:
+            return {"answer": row["answer"], "sources": json.loads(row["sources"])}
+        return None
+    except Exception as e:
+        print(f"⚠️ Semantic cache lookup failed (continuing without cache): {e}")
+        return None
+
+
+async def store(book_id: str, chapter_limit: int, query_embedding: list, answer: str, sources: list):
+    """Saves a freshly generated answer so future similar queries skip the LLM."""
+    try:
+        async with database.AsyncSessionLocal() as db:
+            await db.execute(
+                text("""
+                    INSERT INTO query_cache (book_id, chapter_limit, embedding, answer, sources)
+                    VALUES (:book_id, :chapter_limit, :embedding, :answer, :sources)
+                """).bindparams(bindparam("embedding", type_=Vector(384))),
+                {
+                    "book_id": book_id,
+                    "chapter_limit": chapter_limit,
+                    "embedding": np.asarray(query_embedding, dtype=np.float32),
+                    "answer": answer,
+                    "sources": json.dumps(sources),
+                }
+            )
+            await db.commit()
+    except Exception as e:
+        print(f"⚠️ Semantic cache store failed (answer still returned): {e}")
+
+
+async def invalidate_book(book_id: str):
+    """Drops all cached answers for a book. Called when the book is deleted."""
+    try:
+        async with database.AsyncSessionLocal() as db:
+            await db.execute(
+                text("DELETE FROM query_cache WHERE book_id = :book_id"),
+                {"book_id": book_id}
+            )
+            await db.commit()
+    except Exception as e:
+        print(f"⚠️ Semantic cache invalidation failed for book {book_id}: {e}")